@@ -1,21 +1,25 @@
 # %%
 import os
+from dataclasses import replace
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import torch
 from dotenv import load_dotenv
+from transformers import AutoModel, AutoTokenizer
 
-from haystack import Pipeline
+from haystack import Document, Pipeline, component
 from haystack.document_stores.in_memory import InMemoryDocumentStore
 from haystack.components.retrievers import InMemoryEmbeddingRetriever
 from haystack.components.converters import PyPDFToDocument
 from haystack.components.preprocessors import DocumentCleaner, DocumentSplitter
-from haystack.components.embedders import (
-    SentenceTransformersDocumentEmbedder,
-    SentenceTransformersTextEmbedder,
-)
+from haystack.components.embedders import SentenceTransformersTextEmbedder
 from haystack.components.writers import DocumentWriter
 from haystack.components.builders import ChatPromptBuilder
 from haystack.components.generators.chat import OpenAIChatGenerator
+from haystack.components.generators.utils import print_streaming_chunk
 from haystack.dataclasses import ChatMessage
+from haystack.document_stores.types import DuplicatePolicy
 from haystack.utils import ComponentDevice
 
 # This env variable is needed for the SentenceTransformersDocumentEmbedder to stop throwing warning. Performance impact is unknown.
@@ -30,11 +34,193 @@ if not pdf_path.exists():
     raise FileNotFoundError(f"PDF file not found: {pdf_path}")
 
 # Local embedding model configuration
-MODEL_ID = "BAAI/bge-small-en-v1.5"  # or "thenlper/gte-small", "intfloat/e5-small-v2"
-EMB_DIM = 384  # 384 for bge-small-en-v1.5, use 768 for larger models
+# Late chunking needs a long-context, mean-pooled model so a whole document fits in one pass
+MODEL_ID = "jinaai/jina-embeddings-v2-base-en"  # 8192 token context
+EMB_DIM = 768  # 384 for bge-small-en-v1.5, use 768 for larger models
+
+
+class MatrixInMemoryDocumentStore(InMemoryDocumentStore):
+    """
+    InMemoryDocumentStore that keeps every document embedding in one normalized,
+    contiguous matrix, so a query is scored with a single matrix-vector product and only
+    the top_k scores are sorted. The matrix is rebuilt lazily after writes and deletes.
+
+    `matrix_dtype=np.float16` halves the memory the matrix takes. numpy has no fp16 BLAS
+    kernel, though, so on CPU the float32 default is usually the faster one to score.
+    """
+
+    def __init__(self, matrix_dtype: Any = np.float32, **kwargs):
+        super().__init__(**kwargs)
+        self.matrix_dtype = np.dtype(matrix_dtype)
+        self._emb_docs: List[Document] = []
+        self._emb_matrix: Optional[np.ndarray] = None
+
+    def write_documents(
+        self, documents: List[Document], policy: DuplicatePolicy = DuplicatePolicy.NONE
+    ) -> int:
+        self._emb_matrix = None
+        return super().write_documents(documents, policy=policy)
+
+    def delete_documents(self, document_ids: List[str]) -> None:
+        self._emb_matrix = None
+        super().delete_documents(document_ids)
+
+    def _build_emb_matrix(self) -> None:
+        self._emb_docs = [
+            doc for doc in self.storage.values() if doc.embedding is not None
+        ]
+        if not self._emb_docs:
+            self._emb_matrix = np.zeros((0, 0), dtype=self.matrix_dtype)
+            return
+        matrix = np.asarray([doc.embedding for doc in self._emb_docs], dtype=np.float32)
+        if self.embedding_similarity_function == "cosine":
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self._emb_matrix = np.ascontiguousarray(matrix, dtype=self.matrix_dtype)
+
+    def embedding_retrieval(
+        self,
+        query_embedding: List[float],
+        filters: Optional[Dict[str, Any]] = None,
+        top_k: int = 10,
+        scale_score: bool = False,
+        return_embedding: bool = False,
+    ) -> List[Document]:
+        # Filtered or scaled queries fall back to the stock implementation
+        if filters or scale_score:
+            return super().embedding_retrieval(
+                query_embedding, filters, top_k, scale_score, return_embedding
+            )
+
+        if self._emb_matrix is None:
+            self._build_emb_matrix()
+        if not self._emb_docs or top_k <= 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if self.embedding_similarity_function == "cosine":
+            query = query / np.linalg.norm(query)
+        scores = self._emb_matrix @ query.astype(self.matrix_dtype)
+
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        return [
+            replace(
+                self._emb_docs[i],
+                score=float(scores[i]),
+                embedding=self._emb_docs[i].embedding if return_embedding else None,
+            )
+            for i in top
+        ]
+
+
+@component
+class LateChunkingDocumentEmbedder:
+    """
+    Embeds split documents with late chunking. Each source document is encoded once, in
+    windows of up to `max_tokens`, and every chunk's embedding is the mean of the token
+    embeddings that fall inside it. Overlapping chunks are never re-encoded, and every
+    chunk embedding sees the context around it.
+
+    Expects chunks from DocumentSplitter, whose `split_idx_start` offsets are used to
+    rebuild the text of each source document. `torch_dtype` (e.g. `torch.float16` on a
+    GPU) sets the precision the model is loaded in; token embeddings are pooled in fp32.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        device: str = "cpu",
+        max_tokens: int = 8192,
+        torch_dtype: Optional[torch.dtype] = None,
+    ):
+        self.model_name = model
+        self.device = device
+        self.max_tokens = max_tokens
+        self.torch_dtype = torch_dtype
+        self.tokenizer = None
+        self.model = None
+
+    def warm_up(self):
+        if self.model is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            # Offset mappings are only available from the Rust (fast) tokenizer
+            if not self.tokenizer.is_fast:
+                raise RuntimeError(
+                    f"{self.model_name} has no fast tokenizer, which is needed for "
+                    "token offset mappings."
+                )
+            self.model = AutoModel.from_pretrained(
+                self.model_name, trust_remote_code=True, torch_dtype=self.torch_dtype
+            ).to(self.device)
+            self.model.eval()
+
+    def _embed_tokens(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        encoding = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )
+        input_ids = encoding["input_ids"]
+        window = self.max_tokens - 2  # room for [CLS] and [SEP]
+
+        hidden_states = []
+        with torch.inference_mode():
+            for start in range(0, len(input_ids), window):
+                window_ids = (
+                    [self.tokenizer.cls_token_id]
+                    + input_ids[start : start + window]
+                    + [self.tokenizer.sep_token_id]
+                )
+                output = self.model(
+                    input_ids=torch.tensor([window_ids], device=self.device)
+                )
+                hidden_states.append(
+                    output.last_hidden_state[0, 1:-1].float().cpu().numpy()
+                )
+
+        if not hidden_states:
+            return np.zeros((0, EMB_DIM), dtype=np.float32), np.zeros((0, 2))
+        return np.concatenate(hidden_states), np.asarray(encoding["offset_mapping"])
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        if self.model is None:
+            raise RuntimeError(
+                "The embedding model has not been loaded. Please call warm_up() before running."
+            )
 
-# Initialize document store with correct parameters
-document_store = InMemoryDocumentStore(embedding_similarity_function="cosine")
+        # Group the chunks by the document they were split from, keeping their order
+        chunks_by_source: Dict[str, List[Document]] = {}
+        for doc in documents:
+            chunks_by_source.setdefault(doc.meta.get("source_id", doc.id), []).append(
+                doc
+            )
+
+        embedded = []
+        for chunks in chunks_by_source.values():
+            text, spans = "", []
+            for chunk in chunks:
+                start = chunk.meta.get("split_idx_start", len(text))
+                text = text[:start].ljust(start) + (chunk.content or "")
+                spans.append((start, len(text)))
+
+            hidden_states, offsets = self._embed_tokens(text)
+            for chunk, (chunk_start, chunk_end) in zip(chunks, spans):
+                in_chunk = (offsets[:, 0] >= chunk_start) & (offsets[:, 0] < chunk_end)
+                if not in_chunk.any():
+                    continue  # whitespace-only chunk, nothing to embed
+                embedding = hidden_states[in_chunk].mean(axis=0)
+                embedding /= np.linalg.norm(embedding)
+                embedded.append(replace(chunk, embedding=embedding.tolist()))
+
+        return {"documents": embedded}
+
+
+# Both embedders return L2-normalized vectors, so a dot product already is their cosine
+# similarity and the store doesn't need to normalize each query again
+document_store = MatrixInMemoryDocumentStore(
+    embedding_similarity_function="dot_product"
+)
 
 # Initialize indexing pipeline components
 pdf_converter = PyPDFToDocument()
@@ -42,17 +228,18 @@ cleaner = DocumentCleaner(remove_empty_lines=True, remove_repeated_substrings=Fa
 splitter = DocumentSplitter(
     split_by="word",  # Split by word for better control
     split_length=200,  # Max number of words per chunk
-    split_overlap=20,  # Number of words to overlap between chunks
+    split_overlap=0,  # Late chunking gives each chunk its context, so no overlap is needed
 )
 
-# Replace OpenAI embedder with local SentenceTransformers embedder
-embedder = SentenceTransformersDocumentEmbedder(
+# Embed on the GPU in fp16 when there is one
+USE_GPU = torch.cuda.is_available()
+device = ComponentDevice.from_str("cuda:0" if USE_GPU else "cpu")
+
+# Replace OpenAI embedder with a local late chunking embedder
+embedder = LateChunkingDocumentEmbedder(
     model=MODEL_ID,
-    device=ComponentDevice.from_str(
-        "cpu"
-    ),  # Use ComponentDevice.from_str("cuda") for GPU
-    batch_size=32,
-    normalize_embeddings=True,
+    device=device.to_torch_str(),
+    torch_dtype=torch.float16 if USE_GPU else None,
 )
 
 writer = DocumentWriter(document_store)
@@ -62,7 +249,7 @@ writer = DocumentWriter(document_store)
 # 1. PDF -> Documents (converter)
 # 2. Clean documents (cleaner)
 # 3. Split into chunks (splitter)
-# 4. Generate embeddings (embedder)
+# 4. Generate embeddings with late chunking (embedder)
 # 5. Store in document store (writer)
 indexing_pipeline = Pipeline()
 indexing_pipeline.add_component("converter", pdf_converter)
@@ -86,12 +273,14 @@ print(f"Indexed {indexing_result['writer']['documents_written']} document chunks
 # Initialize RAG pipeline components with local text embedder
 text_embedder = SentenceTransformersTextEmbedder(
     model=MODEL_ID,
-    device=ComponentDevice.from_str(
-        "cpu"
-    ),  # Use ComponentDevice.from_str("cuda") for GPU
+    device=device,
     normalize_embeddings=True,
-    prefix="",  # leave blank for BGE / GTE; use "query: " with e5
+    model_kwargs={"torch_dtype": torch.float16} if USE_GPU else None,
+    trust_remote_code=True,  # needed by jina-embeddings-v2
+    prefix="",  # leave blank for BGE / GTE / Jina; use "query: " with e5
 )
+# Load the model now so the first question doesn't pay for it
+text_embedder.warm_up()
 
 retriever = InMemoryEmbeddingRetriever(document_store)
 
@@ -117,7 +306,8 @@ prompt_template = [
 prompt_builder = ChatPromptBuilder(template=prompt_template)
 # default model is  model: str = "gpt-4o-mini",
 # Still using OpenAI for text generation
-llm = OpenAIChatGenerator()
+# Print the answer token by token as it is generated
+llm = OpenAIChatGenerator(streaming_callback=print_streaming_chunk)
 
 # Build RAG pipeline
 rag_pipeline = Pipeline()
@@ -144,15 +334,15 @@ def ask_question(question: str) -> str:
         str: The answer from the RAG system
     """
     print(f"\nQuestion: {question}")
+    print("Answer: ", end="", flush=True)
     result = rag_pipeline.run(
         data={
             "prompt_builder": {"query": question},
             "text_embedder": {"text": question},
         }
     )
-    answer = result["llm"]["replies"][0].text
-    print(f"Answer: {answer}")
-    return answer
+    print()
+    return result["llm"]["replies"][0].text
 
 
 # Example questions about the RAM AWA interview
@@ -0,0 +1,32 @@
+from sentence_transformers import (
+    SentenceTransformer,
+    export_dynamic_quantized_onnx_model,
+)
+
+from rag.config import (
+    MODEL_ID,
+    ONNX_FILE_SUFFIX,
+    ONNX_MODEL_DIR,
+    ONNX_QUANTIZATION,
+)
+
+
+def main():
+    # Export the model to ONNX, then add an int8 dynamically quantized copy for the
+    # configured CPU, saved as ONNX_FILE_NAME where the pipelines look for it
+    print(f"Exporting {MODEL_ID} to ONNX in {ONNX_MODEL_DIR}...")
+    model = SentenceTransformer(MODEL_ID, backend="onnx")
+    model.save_pretrained(str(ONNX_MODEL_DIR))
+    export_dynamic_quantized_onnx_model(
+        model,
+        ONNX_QUANTIZATION,
+        str(ONNX_MODEL_DIR),
+        file_suffix=ONNX_FILE_SUFFIX,
+    )
+    print(
+        "Done. Re-run the indexing pipeline so stored vectors match the quantized model."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from diskcache import Cache
+from jinja2 import Environment
+from haystack import Document, component
+from haystack.dataclasses import ChatMessage, ChatRole
+from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
+from qdrant_client.http import models
+
+
+@component
+class TunedQdrantEmbeddingRetriever:
+    """
+    Embedding retriever for Qdrant that passes search params (e.g. `hnsw_ef`) with every query.
+
+    `QdrantEmbeddingRetriever` doesn't expose Qdrant's search params, so this component
+    queries the document store's client directly.
+    """
+
+    def __init__(
+        self,
+        document_store: QdrantDocumentStore,
+        top_k: int = 10,
+        search_params: Optional[Dict[str, Any]] = None,
+        scale_score: bool = False,
+        return_embedding: bool = False,
+    ):
+        self.document_store = document_store
+        self.top_k = top_k
+        self.search_params = (
+            models.SearchParams(**search_params) if search_params else None
+        )
+        self.scale_score = scale_score
+        self.return_embedding = return_embedding
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float], top_k: Optional[int] = None):
+        store = self.document_store
+        store._initialize_client()
+        points = store._client.query_points(
+            collection_name=store.index,
+            query=query_embedding,
+            limit=top_k or self.top_k,
+            search_params=self.search_params,
+            with_vectors=self.return_embedding,
+        ).points
+        documents = store._process_query_point_results(
+            points, scale_score=self.scale_score
+        )
+        return {"documents": documents}
+
+    def run_batch(
+        self, query_embeddings: List[List[float]], top_k: Optional[int] = None
+    ) -> List[List[Document]]:
+        """Retrieves documents for several query embeddings in one Qdrant request."""
+        store = self.document_store
+        store._initialize_client()
+        responses = store._client.query_batch_points(
+            collection_name=store.index,
+            requests=[
+                models.QueryRequest(
+                    query=query_embedding,
+                    limit=top_k or self.top_k,
+                    params=self.search_params,
+                    with_payload=True,
+                    with_vector=self.return_embedding,
+                )
+                for query_embedding in query_embeddings
+            ],
+        )
+        return [
+            store._process_query_point_results(
+                response.points, scale_score=self.scale_score
+            )
+            for response in responses
+        ]
+
+
+@component
+class CompiledChatPromptBuilder:
+    """
+    Builds chat messages from a template like ChatPromptBuilder with `query` and
+    `documents` variables, but compiles each message's Jinja template once instead of on
+    every run. The templates are part of the code rather than user input, so a plain
+    environment is used instead of a sandboxed one.
+
+    Only system and user messages are supported.
+    """
+
+    def __init__(self, template: List[ChatMessage]):
+        env = Environment(trim_blocks=True, lstrip_blocks=True, autoescape=False)
+        from_role = {
+            ChatRole.SYSTEM: ChatMessage.from_system,
+            ChatRole.USER: ChatMessage.from_user,
+        }
+        self._messages = [
+            (from_role[message.role], env.from_string(message.text or ""))
+            for message in template
+        ]
+
+    @component.output_types(prompt=List[ChatMessage])
+    def run(self, query: str, documents: List[Document]):
+        prompt = [
+            make_message(template.render(query=query, documents=documents))
+            for make_message, template in self._messages
+        ]
+        return {"prompt": prompt}
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent calls into batches. `submit()` blocks until `batch_fn` has run on
+    a batch of up to `max_batch` items, collected for at most `max_wait_ms` after the
+    first one arrives, and returns the result for the submitted item.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch: int = 32,
+        max_wait_ms: float = 8,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Queue[Tuple[Any, Future]] = Queue()
+        self._worker = threading.Thread(target=self._process_batches, daemon=True)
+        self._worker.start()
+
+    def submit(self, item: Any) -> Any:
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _next_batch(self) -> List[Tuple[Any, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _process_batches(self):
+        while True:
+            items, futures = zip(*self._next_batch())
+            try:
+                results = self.batch_fn(list(items))
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+
+
+@component
+class BatchingTextEmbedder:
+    """
+    Wraps a SentenceTransformersTextEmbedder so that texts embedded concurrently, e.g. by
+    several Streamlit sessions, share one forward pass.
+    """
+
+    def __init__(self, embedder: Any, max_batch: int = 32, max_wait_ms: float = 8):
+        self.embedder = embedder
+        self._batcher = MicroBatcher(self._embed_batch, max_batch, max_wait_ms)
+
+    def warm_up(self):
+        self.embedder.warm_up()
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        embedder = self.embedder
+        return embedder.embedding_backend.embed(
+            [embedder.prefix + text + embedder.suffix for text in texts],
+            batch_size=len(texts),
+            show_progress_bar=False,
+            normalize_embeddings=embedder.normalize_embeddings,
+        )
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        return {"embedding": self._batcher.submit(text)}
+
+
+@component
+class BatchingRetriever:
+    """
+    Wraps a TunedQdrantEmbeddingRetriever so that queries retrieved concurrently share
+    one `query_batch_points` request instead of paying a round trip each.
+    """
+
+    def __init__(self, retriever: Any, max_batch: int = 32, max_wait_ms: float = 8):
+        self.retriever = retriever
+        self._batcher = MicroBatcher(self.retriever.run_batch, max_batch, max_wait_ms)
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float]):
+        return {"documents": self._batcher.submit(query_embedding)}
+
+
+@component
+class EmbedAndRetrieve:
+    """
+    Runs a text embedder and then a retriever in one component, so the pipeline
+    dispatches one component instead of two on the hot path. Outputs the query embedding
+    along with the retrieved documents.
+    """
+
+    def __init__(self, embedder: Any, retriever: Any):
+        self.embedder = embedder
+        self.retriever = retriever
+
+    def warm_up(self):
+        self.embedder.warm_up()
+
+    @component.output_types(documents=List[Document], embedding=List[float])
+    def run(self, text: str):
+        embedding = self.embedder.run(text=text)["embedding"]
+        documents = self.retriever.run(query_embedding=embedding)["documents"]
+        return {"documents": documents, "embedding": embedding}
+
+
+@component
+class CachedTextEmbedder:
+    """
+    Wraps a text embedder with an LRU cache keyed on the whitespace-normalized text,
+    so repeated questions skip the encoder entirely.
+
+    Set `lowercase` for uncased models so questions differing only in case share an
+    entry. With a `disk_cache`, embeddings also persist across restarts and are shared
+    between processes, keyed by the SHA-1 of `namespace` (e.g. the model name) and the
+    normalized text. They are stored as float16 bytes, half the size of float32, and
+    returned in that precision on both hits and misses so every process sees the same
+    vector for a question.
+    """
+
+    def __init__(
+        self,
+        embedder: Any,
+        cache_size: int = 1024,
+        lowercase: bool = False,
+        disk_cache: Optional[Cache] = None,
+        namespace: str = "",
+    ):
+        self.embedder = embedder
+        self.lowercase = lowercase
+        self.disk_cache = disk_cache
+        self.namespace = namespace
+        self._embed = lru_cache(maxsize=cache_size)(self._embed_uncached)
+
+    def warm_up(self):
+        self.embedder.warm_up()
+
+    def _normalize(self, text: str) -> str:
+        text = " ".join(text.split())
+        return text.lower() if self.lowercase else text
+
+    def _embed_uncached(self, text: str) -> Tuple[float, ...]:
+        if self.disk_cache is None:
+            return tuple(self.embedder.run(text=text)["embedding"])
+
+        key = hashlib.sha1(f"{self.namespace}\n{text}".encode()).hexdigest()
+        data = self.disk_cache.get(key)
+        if not isinstance(data, bytes):
+            embedding = self.embedder.run(text=text)["embedding"]
+            data = np.asarray(embedding, dtype=np.float16).tobytes()
+            self.disk_cache.set(key, data)
+        return tuple(np.frombuffer(data, dtype=np.float16).astype(np.float32).tolist())
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        return {"embedding": list(self._embed(self._normalize(text)))}
+
+
+@component
+class CachedRetriever:
+    """
+    Wraps a retriever with an LRU cache from query embedding to retrieved documents.
+
+    Entries expire after `ttl_s` seconds, so documents re-indexed into a running Qdrant
+    server are picked up within that time without restarting the app.
+    """
+
+    def __init__(self, retriever: Any, cache_size: int = 512, ttl_s: float = 300):
+        self.retriever = retriever
+        self.cache_size = cache_size
+        self.ttl_s = ttl_s
+        self._cache: OrderedDict[Tuple[float, ...], Tuple[float, List[Document]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float]):
+        key = tuple(query_embedding)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                expires_at, documents = entry
+                if time.monotonic() < expires_at:
+                    self._cache.move_to_end(key)
+                    return {"documents": documents}
+                del self._cache[key]
+
+        documents = self.retriever.run(query_embedding=query_embedding)["documents"]
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl_s, documents)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return {"documents": documents}
+
+
+class SemanticAnswerCache:
+    """
+    Returns an earlier answer for a question whose embedding is close to a cached one
+    (cosine >= `min_similarity`) and whose retrieved documents largely overlap with the
+    cached ones (Jaccard >= `min_overlap`). Paraphrases of a question that are grounded
+    in the same context skip the LLM, while similar questions that retrieve different
+    documents don't reuse an answer. Answers are only returned for the `namespace` they
+    were stored under (e.g. a hash of the API key that paid for them). Keeps the
+    `max_entries` most recent answers and expects normalized embeddings.
+    """
+
+    def __init__(
+        self,
+        min_similarity: float = 0.97,
+        min_overlap: float = 0.8,
+        max_entries: int = 1024,
+    ):
+        self.min_similarity = min_similarity
+        self.min_overlap = min_overlap
+        self.max_entries = max_entries
+        self._embeddings: Optional[np.ndarray] = None
+        self._entries: List[Tuple[str, FrozenSet[str], str]] = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self, embedding: List[float], doc_ids: FrozenSet[str], namespace: str = ""
+    ) -> Optional[str]:
+        with self._lock:
+            if not self._entries:
+                return None
+            scores = self._embeddings[: len(self._entries)] @ np.asarray(
+                embedding, dtype=np.float32
+            )
+            candidates = np.flatnonzero(scores >= self.min_similarity)
+            for i in candidates[np.argsort(-scores[candidates])]:
+                cached_namespace, cached_ids, answer = self._entries[i]
+                if cached_namespace != namespace:
+                    continue
+                union = len(doc_ids | cached_ids)
+                if union and len(doc_ids & cached_ids) / union >= self.min_overlap:
+                    return answer
+        return None
+
+    def put(
+        self,
+        embedding: List[float],
+        doc_ids: FrozenSet[str],
+        answer: str,
+        namespace: str = "",
+    ):
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros(
+                    (self.max_entries, len(embedding)), dtype=np.float32
+                )
+            i = self._next % self.max_entries
+            if i == len(self._entries):
+                self._entries.append((namespace, doc_ids, answer))
+            else:
+                self._entries[i] = (namespace, doc_ids, answer)
+            self._embeddings[i] = embedding
+            self._next += 1
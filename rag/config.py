@@ -0,0 +1,131 @@
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import psutil
+import torch
+from dotenv import load_dotenv
+from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
+from qdrant_client.http import models
+
+# Embedding model and Qdrant settings shared by index/ and rag/. Documents and queries
+# must be embedded with the same weights and searched in the same collection, so they
+# are only defined here.
+
+# Load environment variables
+load_dotenv()
+
+# Use one torch (OpenMP/MKL) thread per physical core; hyperthreads only add contention
+# on the matmul-bound embedder. Both pipelines import this module, so it runs once per
+# process. torch refuses to resize its interop pool a second time or once parallel work
+# has started, which must not break an import retried after a failure.
+PHYSICAL_CORES = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+torch.set_num_threads(PHYSICAL_CORES)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass
+
+# Local embedding model configuration
+MODEL_ID = "BAAI/bge-small-en-v1.5"
+EMB_DIM = 384
+
+# Int8 ONNX export of MODEL_ID, created by index/export_onnx_model.py. ONNX_QUANTIZATION
+# picks the CPU it was tuned for: arm64, avx2, avx512 or avx512_vnni.
+ONNX_MODEL_DIR = Path("models/bge-small-en-v1.5-onnx")
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx512_vnni")
+if ONNX_QUANTIZATION not in ("arm64", "avx2", "avx512", "avx512_vnni"):
+    raise ValueError(
+        f"Unknown ONNX_QUANTIZATION {ONNX_QUANTIZATION!r}, expected one of arm64, avx2, "
+        "avx512 or avx512_vnni"
+    )
+# sentence-transformers would otherwise name the file after the config's weight dtype,
+# which is uint8 rather than int8 for avx2, so the suffix is passed to the export
+ONNX_FILE_SUFFIX = f"qint8_{ONNX_QUANTIZATION}"
+ONNX_FILE_NAME = f"onnx/model_{ONNX_FILE_SUFFIX}.onnx"
+
+
+def _cpu_has_bf16() -> bool:
+    """Whether the CPU has native bf16 matmuls (AVX512-BF16 or AMX)."""
+    try:
+        cpu_flags = Path("/proc/cpuinfo").read_text()
+    except OSError:
+        return False
+    return "avx512_bf16" in cpu_flags or "amx_bf16" in cpu_flags
+
+
+# Embed on the GPU in fp16 when there is one, with attention running as one fused SDPA
+# kernel. On CPU use the int8 ONNX model, falling back to bf16 torch weights on CPUs
+# with native bf16 support, or to the full precision model otherwise.
+if torch.cuda.is_available():
+    EMBEDDER_DEVICE, EMBEDDER_BACKEND = "cuda:0", "torch"
+    EMBEDDER_MODEL = MODEL_ID
+    EMBEDDER_KWARGS = {"torch_dtype": torch.float16, "attn_implementation": "sdpa"}
+elif (ONNX_MODEL_DIR / ONNX_FILE_NAME).exists():
+    EMBEDDER_DEVICE, EMBEDDER_BACKEND = "cpu", "onnx"
+    EMBEDDER_MODEL, EMBEDDER_KWARGS = str(ONNX_MODEL_DIR), {"file_name": ONNX_FILE_NAME}
+elif _cpu_has_bf16():
+    EMBEDDER_DEVICE, EMBEDDER_BACKEND = "cpu", "torch"
+    EMBEDDER_MODEL = MODEL_ID
+    EMBEDDER_KWARGS = {"torch_dtype": torch.bfloat16, "attn_implementation": "sdpa"}
+else:
+    EMBEDDER_DEVICE, EMBEDDER_BACKEND = "cpu", "onnx"
+    EMBEDDER_MODEL, EMBEDDER_KWARGS = MODEL_ID, None
+
+
+def embedder_id(model: str, model_kwargs: Optional[Dict[str, Any]]) -> str:
+    """
+    Names the exact weights in use (the ONNX file, not just its directory) so that
+    caches and the ingest hash change with them.
+    """
+    return f"{model} {model_kwargs or ''}".strip()
+
+
+EMBEDDER_ID = embedder_id(EMBEDDER_MODEL, EMBEDDER_KWARGS)
+
+# Quantized copy of the vectors that Qdrant keeps in RAM and searches first: "scalar"
+# (int8, 4x smaller) or "binary" (1 bit per dimension, 32x smaller and scored with
+# popcount, but lossier on 384-d vectors). It is fixed when the collection is created.
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "scalar")
+# These are built as qdrant-client models rather than dicts: the gRPC client only
+# converts models to protobuf messages, and a dict's "int8" isn't a valid proto enum.
+QUANTIZATION_CONFIGS = {
+    "scalar": models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, always_ram=True
+        )
+    ),
+    "binary": models.BinaryQuantization(
+        binary=models.BinaryQuantizationConfig(always_ram=True)
+    ),
+}
+HNSW_CONFIG = models.HnswConfigDiff(m=16, ef_construct=128)
+
+# Connect to a Qdrant server over gRPC when QDRANT_URL is set (e.g.
+# http://localhost:6333), otherwise use the embedded store in QDRANT_PATH
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_PATH = "data/qdrant_storage"
+QDRANT_CONNECTION = (
+    {"url": QDRANT_URL, "prefer_grpc": True, "grpc_port": 6334}
+    if QDRANT_URL
+    else {"path": QDRANT_PATH}
+)
+
+
+def create_document_store(**kwargs: Any) -> QdrantDocumentStore:
+    """
+    Returns a QdrantDocumentStore for the shared collection. `kwargs` are passed on to
+    QdrantDocumentStore, e.g. `write_batch_size` for indexing.
+    """
+    return QdrantDocumentStore(
+        **QDRANT_CONNECTION,
+        index="Document",
+        embedding_dim=EMB_DIM,
+        # Full precision vectors and payloads stay on disk; searches run on the
+        # quantized copy kept in RAM and only rescore the top candidates from disk
+        on_disk=True,
+        on_disk_payload=True,
+        hnsw_config=HNSW_CONFIG,
+        quantization_config=QUANTIZATION_CONFIGS[QDRANT_QUANTIZATION],
+        **kwargs,
+    )
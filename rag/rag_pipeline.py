@@ -1,107 +1,241 @@
+import hashlib
 import os
-from dotenv import load_dotenv
+import threading
+from functools import lru_cache
+from queue import Queue
+from typing import FrozenSet, Iterator, List, Optional, Tuple
+import torch
+from diskcache import Cache
 
 from haystack import Pipeline
-from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
-from haystack_integrations.components.retrievers.qdrant import QdrantEmbeddingRetriever
 from haystack.components.embedders.sentence_transformers_text_embedder import (
     SentenceTransformersTextEmbedder,
 )
-from haystack.components.builders.chat_prompt_builder import ChatPromptBuilder
 from haystack.components.generators.chat.openai import OpenAIChatGenerator
 from haystack.dataclasses.chat_message import ChatMessage
+from haystack.dataclasses.streaming_chunk import StreamingChunk
 from haystack.utils.device import ComponentDevice
 from haystack.utils.auth import Secret
 
-# Load environment variables
-load_dotenv()
+from rag.components import (
+    BatchingRetriever,
+    BatchingTextEmbedder,
+    CachedRetriever,
+    CachedTextEmbedder,
+    CompiledChatPromptBuilder,
+    EmbedAndRetrieve,
+    SemanticAnswerCache,
+    TunedQdrantEmbeddingRetriever,
+)
+from rag.config import (
+    EMBEDDER_BACKEND,
+    EMBEDDER_DEVICE,
+    EMBEDDER_KWARGS,
+    EMBEDDER_MODEL,
+    QDRANT_URL,
+    create_document_store,
+    embedder_id,
+)
 
 # This env variable is needed for the SentenceTransformersDocumentEmbedder to stop throwing warning. Performance impact is unknown.
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-# Local embedding model configuration
-MODEL_ID = "BAAI/bge-small-en-v1.5"
-EMB_DIM = 384
+# A query encoder distilled from MODEL_ID (e.g. a 4-layer student trained to reproduce
+# its embeddings) can replace it at query time to cut query latency. The indexed
+# documents stay embedded by MODEL_ID, so the student must share its embedding space.
+QUERY_MODEL_ID = os.getenv("QUERY_MODEL_ID")
+if QUERY_MODEL_ID:
+    QUERY_EMBEDDER_MODEL = QUERY_MODEL_ID
+    QUERY_EMBEDDER_KWARGS = None if EMBEDDER_BACKEND == "onnx" else EMBEDDER_KWARGS
+else:
+    QUERY_EMBEDDER_MODEL, QUERY_EMBEDDER_KWARGS = EMBEDDER_MODEL, EMBEDDER_KWARGS
+QUERY_EMBEDDER_ID = embedder_id(QUERY_EMBEDDER_MODEL, QUERY_EMBEDDER_KWARGS)
 
 # Initialize Qdrant document store
-document_store = QdrantDocumentStore(
-    path="data/qdrant_storage",
-    index="Document",
-    embedding_dim=EMB_DIM,
-)
+document_store = create_document_store()
 
 # Initialize RAG pipeline components with local text embedder
-text_embedder = SentenceTransformersTextEmbedder(
-    model=MODEL_ID,
-    device=ComponentDevice.from_str("cpu"),
+query_embedder = SentenceTransformersTextEmbedder(
+    model=QUERY_EMBEDDER_MODEL,
+    device=ComponentDevice.from_str(EMBEDDER_DEVICE),
     normalize_embeddings=True,
     prefix="",  # leave blank for BGE / GTE; use "query: " with e5
+    backend=EMBEDDER_BACKEND,
+    model_kwargs=QUERY_EMBEDDER_KWARGS,
+)
+# Load the model once at import so the first question doesn't pay for it, and skip
+# autograd bookkeeping in its forward passes
+query_embedder.warm_up()
+query_embedder.embedding_backend.embed = torch.inference_mode()(
+    query_embedder.embedding_backend.embed
+)
+
+# The lowercased text is what gets embedded on a cache miss, so questions may only share
+# an entry regardless of case if the query model lowercases its input anyway (BGE does,
+# a cased QUERY_MODEL_ID student may not)
+_query_model = query_embedder.embedding_backend.model
+QUERY_MODEL_UNCASED = bool(
+    getattr(_query_model[0], "do_lower_case", False)
+    or getattr(_query_model.tokenizer, "do_lower_case", False)
+)
+
+# Repeated questions hit the embedding and retrieval caches instead of the model and Qdrant,
+# and questions from concurrent sessions share one forward pass. The embedding cache
+# persists in data/embed_cache across restarts.
+text_embedder = CachedTextEmbedder(
+    BatchingTextEmbedder(query_embedder, max_batch=32, max_wait_ms=8),
+    lowercase=QUERY_MODEL_UNCASED,
+    disk_cache=Cache("data/embed_cache"),
+    namespace=QUERY_EMBEDDER_ID,
+)
+
+qdrant_retriever = TunedQdrantEmbeddingRetriever(
+    document_store=document_store,
+    search_params={
+        "hnsw_ef": 64,
+        "exact": False,
+        # Rescore 2x top_k quantized candidates with the original vectors to keep recall
+        "quantization": {"ignore": False, "rescore": True, "oversampling": 2.0},
+    },
+)
+
+# On a Qdrant server, cache misses from concurrent sessions are sent as one batched
+# query. The embedded store just loops over a batch, so there batching would only add
+# its wait window to every query.
+retriever = CachedRetriever(
+    BatchingRetriever(qdrant_retriever, max_batch=32, max_wait_ms=8)
+    if QDRANT_URL
+    else qdrant_retriever
 )
 
-retriever = QdrantEmbeddingRetriever(document_store=document_store)
+# Run one query end to end at import, bypassing the caches, so the tokenizer, the first
+# forward pass's buffers and the Qdrant collection are ready before the first question
+qdrant_retriever.run(query_embedding=query_embedder.run(text="warm up")["embedding"])
 
+# The invariant instructions come first and the question last, without template
+# indentation, so every prompt starts with the same tokens and OpenAI's automatic prompt
+# caching can reuse the prefill of that prefix.
 prompt_template = [
+    ChatMessage.from_system(
+        "Given documents from the RAM AWA interview, answer the question accurately and "
+        "concisely. Answer based on the provided documents. If the information is not "
+        "available in the documents, please say so."
+    ),
     ChatMessage.from_user(
-        """
-        Given these documents from the RAM AWA interview, answer the question accurately and concisely.
-        
-        Documents:
-        {% for doc in documents %}
-            {{ doc.content }}
-        {% endfor %}
-        
-        Question: {{query}}
-        
-        Answer based on the provided documents. If the information is not available in the documents, please say so.
-        Answer:
-        """
-    )
+        "Documents:\n"
+        "{% for doc in documents %}{{ doc.content }}\n\n{% endfor %}"
+        "Question: {{query}}\n"
+        "Answer:"
+    ),
 ]
 
-prompt_builder = ChatPromptBuilder(template=prompt_template)
+# Compiled once here rather than on every question
+prompt_builder = CompiledChatPromptBuilder(template=prompt_template)
 
-# Note: default_llm is removed as API key is now mandatory for ask_question.
-# The main() function below will need to handle API key provision for its own testing.
+# Build the retrieval half of the RAG pipeline once and reuse it for every question.
+# The LLM is kept outside the pipeline because it depends on the user's API key and
+# Haystack components can't be shared between pipelines.
+# Embedding and retrieval run as one fused component to halve the pipeline's dispatch
+# overhead.
+rag_pipeline = Pipeline()
+rag_pipeline.add_component("retriever", EmbedAndRetrieve(text_embedder, retriever))
+rag_pipeline.add_component("prompt_builder", prompt_builder)
 
+rag_pipeline.connect("retriever.documents", "prompt_builder.documents")
 
-# Function to ask questions - API key is now mandatory
-def ask_question(question: str, api_key: str) -> str:
-    # Instantiate components locally for each call
-    local_text_embedder = SentenceTransformersTextEmbedder(
-        model=MODEL_ID,  # Uses global MODEL_ID
-        device=ComponentDevice.from_str("cpu"),  # Uses global ComponentDevice
-        normalize_embeddings=True,
-        prefix="",  # as per original global definition
-    )
 
-    local_retriever = QdrantEmbeddingRetriever(
-        document_store=document_store  # Uses global document_store
-    )
+@lru_cache(maxsize=8)
+def _get_llm(api_key: str) -> OpenAIChatGenerator:
+    """Returns a chat generator for the given API key, reusing it across questions."""
+    return OpenAIChatGenerator(api_key=Secret.from_token(api_key))
 
-    # prompt_template is global
-    local_prompt_builder = ChatPromptBuilder(
-        template=prompt_template  # Uses global prompt_template
-    )
 
-    user_llm = OpenAIChatGenerator(api_key=Secret.from_token(api_key))
+# Reuses answers for paraphrased questions that retrieve (almost) the same documents.
+# Answers are scoped to the API key that paid for them, so a session never gets another
+# user's answers without its own key being used.
+answer_cache = SemanticAnswerCache(min_similarity=0.97, min_overlap=0.8)
 
-    pipeline_to_run = Pipeline()
-    pipeline_to_run.add_component("text_embedder", local_text_embedder)
-    pipeline_to_run.add_component("retriever", local_retriever)
-    pipeline_to_run.add_component("prompt_builder", local_prompt_builder)
-    pipeline_to_run.add_component("llm", user_llm)
 
-    pipeline_to_run.connect("text_embedder.embedding", "retriever.query_embedding")
-    pipeline_to_run.connect("retriever.documents", "prompt_builder.documents")
-    pipeline_to_run.connect("prompt_builder", "llm")
+class _StreamCancelled(Exception):
+    """Raised from the streaming callback to stop a generation nobody is reading."""
 
-    result = pipeline_to_run.run(
+
+def _build_prompt(
+    question: str,
+) -> Tuple[List[ChatMessage], List[float], FrozenSet[str]]:
+    """Returns the prompt for `question`, its embedding and retrieved document ids."""
+    result = rag_pipeline.run(
         data={
             "prompt_builder": {"query": question},
-            "text_embedder": {"text": question},
-        }
+            "retriever": {"text": question},
+        },
+        include_outputs_from={"retriever"},
+    )
+    doc_ids = frozenset(doc.id for doc in result["retriever"]["documents"])
+    return (
+        result["prompt_builder"]["prompt"],
+        result["retriever"]["embedding"],
+        doc_ids,
     )
 
-    answer = result["llm"]["replies"][0].text
-    print(f"Answer: {answer}")
-    return answer
+
+# Function to ask questions - API key is now mandatory
+def ask_question(question: str, api_key: str) -> str:
+    """Returns the answer to `question`, printing it to stdout as it streams in."""
+    parts = []
+    print("Answer: ", end="", flush=True)
+    for content in ask_question_stream(question, api_key):
+        print(content, end="", flush=True)
+        parts.append(content)
+    print()
+    return "".join(parts)
+
+
+def ask_question_stream(question: str, api_key: str) -> Iterator[str]:
+    """
+    Yields the answer to `question` chunk by chunk as the LLM generates it. If the caller
+    stops iterating (e.g. the Streamlit session goes away), the OpenAI stream is aborted
+    instead of generating the rest of the answer in the background.
+    """
+    prompt, embedding, doc_ids = _build_prompt(question)
+    key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+    if (answer := answer_cache.get(embedding, doc_ids, key_hash)) is not None:
+        yield answer
+        return
+
+    chunks: Queue[Optional[str]] = Queue()
+    cancelled = threading.Event()
+
+    def on_chunk(chunk: StreamingChunk) -> None:
+        if cancelled.is_set():
+            raise _StreamCancelled()
+        chunks.put(chunk.content)
+
+    errors: List[Exception] = []
+
+    def generate() -> None:
+        try:
+            _get_llm(api_key).run(messages=prompt, streaming_callback=on_chunk)
+        except _StreamCancelled:
+            pass
+        except Exception as error:
+            errors.append(error)
+        finally:
+            chunks.put(None)
+
+    # Each answer streams from its own thread so concurrent sessions never wait for
+    # another session's generation to finish before getting their first token
+    threading.Thread(target=generate, daemon=True).start()
+    parts = []
+    try:
+        while (content := chunks.get()) is not None:
+            if content:
+                parts.append(content)
+                yield content
+    finally:
+        cancelled.set()
+    # Re-raise any error from the LLM call
+    if errors:
+        raise errors[0]
+    if parts:
+        answer_cache.put(embedding, doc_ids, "".join(parts), key_hash)
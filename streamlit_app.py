@@ -1,19 +1,28 @@
+import importlib
 import os
+import threading
 os.environ["STREAMLIT_SERVER_ENABLE_FILE_WATCHER"] = "false"
 import streamlit as st
-from rag.rag_pipeline import ask_question #, rag_pipeline # rag_pipeline is not directly used here anymore
 
 # Configuration for conversation history in order of recency
 MAX_HISTORY_LENGTH = 10
 
-# Initialize the RAG pipeline (if not already handled in ask_question or its module)
-# This might be redundant if rag_pipeline.py handles its own initialization upon import.
-# Consider if rag_pipeline.run() is called within ask_question or if the pipeline object itself needs to be present.
-# If ask_question is truly self-contained, this line might not be necessary.
-# However, to be safe and ensure all components are ready:
-# rag_pipeline.warm_up() # Or any specific initialization method if warm_up() is not the one.
-                        # If rag_pipeline object is not directly used by ask_question after initial setup,
-                        # this might be better placed inside rag_pipeline.py to run on import.
+
+@st.cache_resource
+def start_rag_warm_up() -> threading.Thread:
+    """
+    Imports the RAG pipeline in a background thread, once per server process. Importing
+    it loads and warms up the embedding model, so the page renders while that happens
+    and the first question doesn't pay for it.
+    """
+    thread = threading.Thread(
+        target=importlib.import_module, args=("rag.rag_pipeline",), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+rag_warm_up = start_rag_warm_up()
 
 
 st.title("AWA Current Magazine QnA")
@@ -31,19 +40,15 @@ Ask questions about the contents of  AWA Current Magazine .
 """)
 
 # Display chat history (oldest first)
-if st.session_state.history:
-    st.markdown("### Conversation History")
-    for i, (q, a) in enumerate(st.session_state.history):
-        st.markdown(f"**Q{i+1}:** {q}")
-        st.markdown(f"**A{i+1}:** {a}")
-        st.markdown("---")
-
-# Create a form for user input
-with st.form(key="chat_input_form"):
-    user_question_text = st.text_input("Ask your question:")
-    submit_button = st.form_submit_button(label="Ask")
-
-if submit_button and user_question_text:
+for q, a in st.session_state.history:
+    with st.chat_message("user"):
+        st.markdown(q)
+    with st.chat_message("assistant"):
+        st.markdown(a)
+
+# The chat input is cleared on submit, so new turns are appended below the history
+# without an extra st.rerun() of the whole script
+if user_question_text := st.chat_input("Ask your question:"):
     if not openai_api_key:
         st.warning("Please enter your OpenAI API Key in the sidebar to continue.")
         st.stop()
@@ -51,20 +56,22 @@ if submit_button and user_question_text:
         st.warning("Please enter a valid OpenAI API Key, starting with 'sk-'.")
         st.stop()
 
-    with st.spinner("Finding an answer..."):
-        answer = ask_question(user_question_text, api_key=openai_api_key)
-        # Display the current answer (optional, as it will appear in history)
-        # st.write("Answer:") 
-        # st.write(answer)
-
-        # Add current Q&A to history
-        st.session_state.history.append((user_question_text, answer))
-        # Keep only the last N conversations
-        if len(st.session_state.history) > MAX_HISTORY_LENGTH:
-            st.session_state.history = st.session_state.history[-MAX_HISTORY_LENGTH:]
-        
-        # Rerun to update the history display and show cleared input field
-        st.rerun()
+    with st.chat_message("user"):
+        st.markdown(user_question_text)
+    if rag_warm_up.is_alive():
+        with st.spinner("Loading the embedding model..."):
+            rag_warm_up.join()
+    from rag.rag_pipeline import ask_question_stream
+
+    # Stream the answer as it is generated instead of waiting for the full reply
+    with st.chat_message("assistant"):
+        answer = st.write_stream(ask_question_stream(user_question_text, api_key=openai_api_key))
+
+    # Add current Q&A to history
+    st.session_state.history.append((user_question_text, answer))
+    # Keep only the last N conversations
+    if len(st.session_state.history) > MAX_HISTORY_LENGTH:
+        st.session_state.history = st.session_state.history[-MAX_HISTORY_LENGTH:]
 
 
 st.sidebar.header("About")